@@ -1,8 +1,18 @@
 # app/app.py
-import os, json, requests
+import hashlib, os, requests, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import orjson
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+import pyarrow.fs as pafs
 import streamlit as st
+from shapely.geometry import mapping, shape
 
 st.set_page_config(page_title="NYC Yellow Taxi — Jun–Jul 2025", layout="wide")
 
@@ -10,67 +20,369 @@ st.set_page_config(page_title="NYC Yellow Taxi — Jun–Jul 2025", layout="wide
 BUCKET = os.getenv("BUCKET", "nyc-taxi-portfolio-frm")
 PREFIX = os.getenv("PREFIX", "agg_v3")  # mantém agg_v3 (underscore)
 S3_PATH = f"s3://{BUCKET}/{PREFIX}"
+CACHE_DIR = os.getenv("DASH_CACHE_DIR", "/tmp/dash-cache")  # cache IPC local (cold start)
 
-# 🔧 IMPORTANTE: nunca use anônimo aqui; deixe o boto3 achar credenciais (role/perfil/secrets)
-STORAGE_OPTS: dict = {"anon": False}
-# (Opcional) Se você quiser forçar chaves explícitas via env/secrets, mantemos compatível:
+# 🔧 IMPORTANTE: leitura S3 direto pelo C++ do Arrow (sem s3fs/fsspec) — solta o GIL
+# durante os fetches e paraleliza colunas/row-groups. Sem chaves explícitas, o Arrow
+# resolve credenciais pela cadeia padrão (role/perfil/secrets); nunca anônimo aqui.
+_FS_KW: dict = {}
 if os.getenv("AWS_ACCESS_KEY_ID") and os.getenv("AWS_SECRET_ACCESS_KEY"):
-    STORAGE_OPTS.update({
-        "key": os.getenv("AWS_ACCESS_KEY_ID"),
-        "secret": os.getenv("AWS_SECRET_ACCESS_KEY")
+    _FS_KW.update({
+        "access_key": os.getenv("AWS_ACCESS_KEY_ID"),
+        "secret_key": os.getenv("AWS_SECRET_ACCESS_KEY")
     })
 if os.getenv("AWS_SESSION_TOKEN"):
-    STORAGE_OPTS["token"] = os.getenv("AWS_SESSION_TOKEN")
+    _FS_KW["session_token"] = os.getenv("AWS_SESSION_TOKEN")
 if os.getenv("AWS_DEFAULT_REGION"):
-    STORAGE_OPTS["client_kwargs"] = {"region_name": os.getenv("AWS_DEFAULT_REGION")}
+    _FS_KW["region"] = os.getenv("AWS_DEFAULT_REGION")
+_FS = pafs.S3FileSystem(**_FS_KW)
 
 # ========= HELPERS =========
 GEOJSON_URL = "https://data.cityofnewyork.us/api/geospatial/8meu-9t5y?method=export&format=GeoJSON"
 
+def _index_features(gj):
+    # id inteiro por feature + dict zone→id: o Plotly casa locations pelo id
+    # em O(1), em vez de varrer properties.zone do GeoJSON para cada linha
+    zone2fid = {}
+    for i, feat in enumerate(gj["features"]):
+        feat["id"] = i
+        zone2fid[feat["properties"]["zone"]] = i
+    return gj, zone2fid
+
+@st.cache_resource(show_spinner=False)
 def load_taxi_geojson():
+    # parse uma vez por processo (cache_resource) e com orjson, que decodifica
+    # os megabytes de polígonos bem mais rápido que o json da stdlib
     for path in ["data/NYC Taxi Zones.geojson", "data/taxi_zones.geojson"]:
         if os.path.exists(path):
             try:
-                with open(path, "r", encoding="utf-8") as f:
-                    gj = json.load(f)
+                with open(path, "rb") as f:
+                    gj = orjson.loads(f.read())
                 if isinstance(gj, dict) and gj.get("type") == "FeatureCollection":
-                    return gj
+                    return _index_features(gj)
             except Exception:
                 pass
     r = requests.get(GEOJSON_URL, timeout=30)
     r.raise_for_status()
-    return r.json()
+    return _index_features(orjson.loads(r.content))
+
+@st.cache_resource(show_spinner=False)
+def simplify_taxi_geojson():
+    """Versão enxuta do GeoJSON, só para desenhar o mapa: simplify preserva a
+    topologia e descarta a maioria dos vértices, encolhendo (muito) o payload
+    que o Plotly serializa para o browser a cada render. Ficam apenas id e
+    geometria; o GeoJSON original continua sendo a fonte do índice zone→id."""
+    gj, _ = load_taxi_geojson()
+    feats = []
+    for feat in gj["features"]:
+        geom = shape(feat["geometry"]).simplify(0.0005, preserve_topology=True)
+        feats.append({"type": "Feature", "id": feat["id"], "geometry": mapping(geom)})
+    return {"type": "FeatureCollection", "features": feats}
+
+# Leitura coalescida: pre_buffer calcula os byte-ranges de todas as colunas/row
+# groups de antemão e junta vizinhos em GETs de até 32 MB, em vez de uma leitura
+# pequena por coluna — menos round-trips no caminho S3, que é o gargalo
+_PQ_FORMAT = pads.ParquetFileFormat(
+    default_fragment_scan_options=pads.ParquetFragmentScanOptions(
+        pre_buffer=True,
+        cache_options=pa.CacheOptions(hole_size_limit=8 << 20, range_size_limit=32 << 20),
+    )
+)
+
+@st.cache_resource(show_spinner=False)
+def open_dataset(path: str) -> pads.Dataset:
+    # a descoberta (LIST + schema) também custa round-trips; faz uma vez por caminho.
+    # partitioning="hive": se o CTAS publicar o prefixo particionado (ex.:
+    # pickup_month=2025-06/), os diretórios viram colunas e o filtro de data
+    # poda partições inteiras antes de tocar metadado de arquivo; em prefixos
+    # planos (layout atual) a descoberta é idêntica
+    return pads.dataset(
+        path.removeprefix("s3://"), filesystem=_FS, format=_PQ_FORMAT,
+        partitioning="hive",
+    )
+
+def _scan_table(ds: pads.Dataset, cols, flt=None) -> pa.Table:
+    scanner = pads.Scanner.from_dataset(
+        ds, columns=cols, filter=flt,
+        batch_size=131072, fragment_readahead=4, use_threads=True,
+    )
+    return scanner.to_table()
+
+def _day_bounds(schema: pa.Schema, d0, d1):
+    # agg grava pickup_date como date ou timestamp; casa o escalar com o tipo da coluna
+    if pa.types.is_timestamp(schema.field("pickup_date").type):
+        return pd.Timestamp(d0), pd.Timestamp(d1)
+    return d0, d1
+
+def _shrink(tbl: pa.Table) -> pa.Table:
+    """Estreita os tipos logo após o load: os agregados cabem folgados em
+    int32/float32 (hora em int8), e metade da largura é metade da banda em
+    todo scan/groupby daqui pra frente. Chaves string (borough/zone/
+    payment_type) viram dicionário: o group_by passa a hashear códigos int32
+    em vez do texto, e no pandas elas chegam como category."""
+    fields = []
+    for f in tbl.schema:
+        if f.name == "pickup_hour":
+            fields.append(pa.field(f.name, pa.int8()))
+        elif pa.types.is_string(f.type) or pa.types.is_large_string(f.type):
+            fields.append(pa.field(f.name, pa.dictionary(pa.int32(), f.type)))
+        elif pa.types.is_int64(f.type):
+            fields.append(pa.field(f.name, pa.int32()))
+        elif pa.types.is_float64(f.type):
+            fields.append(pa.field(f.name, pa.float32()))
+        else:
+            fields.append(f)
+    return tbl.cast(pa.schema(fields))
+
+def table_to_df(tbl: pa.Table) -> pd.DataFrame:
+    # datas nativas (datetime64) direto do Arrow: dispensa o re-parse do pd.to_datetime
+    return tbl.to_pandas(date_as_object=False, split_blocks=True)
+
+def _ipc_cache_path(path: str, columns: tuple | None) -> str:
+    key = hashlib.sha1(f"{path}|{columns}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.arrow")
+
+def _s3_fingerprint(path: str) -> str:
+    # assinatura do prefixo (path+size+mtime de cada objeto): se o ETL regravar
+    # os Parquet, a assinatura muda e o cache IPC local é refeito
+    infos = _FS.get_file_info(pafs.FileSelector(path.removeprefix("s3://"), recursive=True))
+    sig = sorted((i.path, i.size, str(i.mtime)) for i in infos if i.type == pafs.FileType.File)
+    return hashlib.sha1(repr(sig).encode()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def read_parquet_table(path: str, columns: tuple | None = None) -> pa.Table:
+    fp = _ipc_cache_path(path, columns)
+    try:
+        sig = _s3_fingerprint(path)
+    except Exception:
+        sig = None  # sem LIST agora (rede?); um cache existente ainda vale mais que nada
+    if os.path.exists(fp):
+        try:
+            with open(fp + ".sig", "r") as f:
+                cached_sig = f.read()
+        except OSError:
+            cached_sig = ""
+        if sig is None or cached_sig == sig:
+            try:
+                # IPC local via mmap: um restart do container recarrega em
+                # milissegundos (zero-copy) em vez de rebaixar tudo do S3
+                return pa.ipc.open_file(pa.memory_map(fp)).read_all()
+            except Exception:
+                pass  # cache truncado/incompatível: volta ao S3
+    ds = open_dataset(path)
+    cols = [c for c in columns if c in ds.schema.names] if columns else None
+    tbl = _shrink(_scan_table(ds, cols))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with pa.OSFile(fp, "wb") as f, pa.ipc.new_file(f, tbl.schema) as w:
+            w.write_table(tbl)
+        if sig:
+            with open(fp + ".sig", "w") as f:
+                f.write(sig)
+    except Exception:
+        pass  # cache em disco é melhor-esforço; sem ele o app segue igual
+    return tbl
+
+def read_parquet_range(path: str, columns: tuple, d0, d1) -> pa.Table:
+    """Scan com pushdown de predicado/projeção: as estatísticas de row group
+    pulam o que está fora do período, então só o intervalo pedido sai do S3."""
+    ds = open_dataset(path)
+    cols = [c for c in columns if c in ds.schema.names]
+    lo, hi = _day_bounds(ds.schema, d0, d1)
+    flt = (pads.field("pickup_date") >= lo) & (pads.field("pickup_date") <= hi)
+    if "pickup_month" in ds.schema.names:
+        # prefixo particionado por mês (hive): predicado redundante sobre a
+        # coluna de partição, só para o dataset podar diretórios inteiros
+        # antes de abrir footer de Parquet
+        months = pd.period_range(d0, d1, freq="M").strftime("%Y-%m").tolist()
+        flt = flt & pads.field("pickup_month").isin(months)
+    tbl = _shrink(_scan_table(ds, cols, flt))
+    if "pickup_date" in tbl.schema.names:
+        # DOW calculado uma vez, ainda no load cacheado (int8; segunda=1,
+        # igual ao antigo dt.dayofweek + 1 recalculado a cada rerun)
+        dow = pc.cast(pc.add(pc.day_of_week(tbl["pickup_date"]), 1), pa.int8())
+        tbl = tbl.append_column("pickup_dow_num", dow)
+    return tbl
+
+class ScanCache:
+    """Cache ganancioso de scans: quem estreita o filtro é servido de qualquer
+    resposta já em memória cujo intervalo cubra o pedido (filtro local em Arrow);
+    só vai ao S3 quando nenhuma cobre. Troca RAM por round-trips. Tables são
+    imutáveis, então servir do cache dispensa cópia defensiva.
+
+    A instância é compartilhada entre sessões (st.cache_resource) e cada
+    sessão roda em sua própria thread: o lock cobre lookup→fetch→store para
+    o dict não mudar de tamanho debaixo da iteração — e, de quebra, duas
+    sessões pedindo o mesmo intervalo não disparam scans S3 duplicados."""
+
+    def __init__(self):
+        self._store: dict = {}
+        self._lock = threading.Lock()
+
+    def scan(self, path: str, columns: tuple, d0, d1) -> pa.Table:
+        with self._lock:
+            entries = self._store.setdefault((path, columns), {})
+            for (lo, hi), tbl in entries.items():
+                if lo <= d0 and d1 <= hi:
+                    a, b = _day_bounds(tbl.schema, d0, d1)
+                    return tbl.filter((pc.field("pickup_date") >= a) & (pc.field("pickup_date") <= b))
+            tbl = read_parquet_range(path, columns, d0, d1)
+            # o intervalo novo pode englobar respostas antigas; descarta as cobertas
+            for k in [k for k in entries if d0 <= k[0] and k[1] <= d1]:
+                del entries[k]
+            entries[(d0, d1)] = tbl
+            return tbl
+
+@st.cache_resource(show_spinner=False)
+def get_scan_cache() -> ScanCache:
+    return ScanCache()
+
+@st.cache_resource(show_spinner=False)
+def try_zone_hour_cube() -> pa.Table | None:
+    """Cubo opcional zona×hora (CTAS 'agg_zone_hour' no ETL do Athena:
+    GROUP BY borough, zone, pickup_hour). Com ele, ranking e mapa respondem
+    EXATAMENTE ao filtro de hora — são ≤ ~265×24 linhas somadas no cliente.
+    Sem ele, o app cai na aproximação por razão global de sempre."""
+    try:
+        return read_parquet_table(f"{S3_PATH}/agg_zone_hour/", ZONE_HOUR_COLS)
+    except Exception:
+        return None
+
+@st.cache_data(show_spinner=False)
+def dow_hour_matrix() -> np.ndarray:
+    """Matriz (7,24) de trips por DOW×hora, montada uma vez (np.add.at) sobre
+    agg_hour_dow. Razões por DOW, razão global e heatmap saem de fatias dela,
+    em vez de três varreduras da tabela a cada rerun."""
+    hd = table_to_df(read_parquet_table(f"{S3_PATH}/agg_hour_dow/", HOURDOW_COLS))
+    assert {"pickup_dow_num", "pickup_hour", "trips"}.issubset(hd.columns), "agg_hour_dow com colunas inesperadas."
+    m = np.zeros((7, 24), dtype=np.int64)
+    np.add.at(m, (hd["pickup_dow_num"].to_numpy() - 1, hd["pickup_hour"].to_numpy()),
+              hd["trips"].to_numpy())
+    return m
+
+@st.cache_data(show_spinner=False)
+def hour_ratio_lut(hr_min: int, hr_max: int) -> np.ndarray:
+    """LUT de 8 posições (índice = dow) com a fração de trips dentro do
+    intervalo de horas. Aplicar a razão vira um gather vetorizado no L1,
+    em vez de um lookup de hash por linha via .map + fillna."""
+    m = dow_hour_matrix()
+    dow_tot = m.sum(axis=1)
+    dow_sel = m[:, hr_min:hr_max + 1].sum(axis=1)
+    lut = np.zeros(8)
+    np.divide(dow_sel, dow_tot, out=lut[1:], where=dow_tot > 0)
+    return lut
+
+@st.cache_data(show_spinner=False)
+def compute_daily_series(d0, d1, hr_min: int, hr_max: int) -> pd.DataFrame:
+    """Série diária ponderada pelo DOW, cacheada pela tupla de filtros: mexer
+    num widget que não muda a série (e qualquer rerun repetido) não refaz
+    scan, gather nem groupby."""
+    df = table_to_df(get_scan_cache().scan(f"{S3_PATH}/agg_daily/", DAILY_COLS, d0, d1))
+    lut = hour_ratio_lut(hr_min, hr_max)
+    df["trips_plot"] = df["trips"].to_numpy() * lut[df["pickup_dow_num"].to_numpy()]
+    if df["pickup_date"].is_unique:
+        # caso normal do agg_daily (uma linha por data): o groupby seria um
+        # no-op pagando build de hash — basta projetar e ordenar
+        out = df[["pickup_date", "trips_plot"]].sort_values("pickup_date")
+    else:
+        out = (
+            df.groupby("pickup_date", as_index=False)["trips_plot"].sum()
+            .sort_values("pickup_date")
+        )
+    # eixo x como string pronta: o Plotly serializa direto, sem reconverter datetime
+    out["iso_date"] = out["pickup_date"].dt.strftime("%Y-%m-%d")
+    return out
 
 @st.cache_data(show_spinner=False)
-def read_parquet_dir(path: str) -> pd.DataFrame:
-    return pd.read_parquet(path, storage_options=STORAGE_OPTS)
+def compute_zone_tables(hr_min: int, hr_max: int):
+    """Top-15 e contagem por zona para o intervalo de horas — exatos com o
+    cubo agg_zone_hour, senão escalados pela razão global. Cacheados pela
+    tupla de filtro de hora."""
+    cube = try_zone_hour_cube()
+    if cube is not None:
+        src   = cube.filter((pc.field("pickup_hour") >= hr_min) & (pc.field("pickup_hour") <= hr_max))
+        scale = 1.0
+    else:
+        src = read_parquet_table(f"{S3_PATH}/agg_zone_pickup/", ZONE_COLS)
+        m = dow_hour_matrix()
+        tot = int(m.sum())
+        scale = float(m[:, hr_min:hr_max + 1].sum() / tot) if tot else 0.0
+    aggs = [("trips", "sum")]
+    if "revenue_total" in src.schema.names:
+        aggs.append(("revenue_total", "sum"))
+    top = (
+        src.group_by(["borough", "zone"])
+        .aggregate(aggs)
+        .to_pandas()
+        .rename(columns={"trips_sum": "trips", "revenue_total_sum": "revenue"})
+        .nlargest(15, "trips")  # seleção parcial O(N log k), sem ordenar tudo
+    )
+    cols = [c for c in ("trips", "revenue") if c in top.columns]
+    top[cols] = top[cols] * scale
+    counts = (
+        src.group_by("zone")
+        .aggregate([("trips", "sum")])
+        .to_pandas()
+        .rename(columns={"trips_sum": "trips"})
+    )
+    counts["trips"] = counts["trips"] * scale
+    return top, counts, cube is not None
 
-def guard_df(df: pd.DataFrame, name: str):
+@st.cache_data(show_spinner=False)
+def heatmap_figure(hr_min: int, hr_max: int) -> go.Figure:
+    """Heatmap DOW×hora montado direto em go.Heatmap: a matriz NumPy vai
+    inteira para o encoder do Plotly (array tipado no JSON), sem o DataFrame
+    intermediário nem as listas Python que o px.imshow geraria. Figura
+    cacheada por intervalo de horas — rerender só replota."""
+    fig = go.Figure(go.Heatmap(
+        z=dow_hour_matrix()[:, hr_min:hr_max + 1],
+        x=list(range(hr_min, hr_max + 1)),
+        y=list(range(1, 8)),
+        colorbar={"title": "trips"},
+    ))
+    fig.update_layout(
+        title="Heatmap (dia da semana × hora)",
+        xaxis_title="hora", yaxis_title="dia da semana",
+        yaxis_autorange="reversed",  # dow=1 no topo, como o px.imshow desenhava
+    )
+    return fig
+
+def guard_df(df: pa.Table | pd.DataFrame | None, name: str):
     if df is None or len(df) == 0:
         st.error(f"Nenhum dado em {name}. Confira no S3: {S3_PATH}/{name}/")
         st.stop()
 
 # ========= LOAD DATA =========
+# daily/pay chegam depois, via scan filtrado pelo período escolhido; aqui só o
+# necessário para montar os filtros (datas disponíveis) e as bases usadas inteiras.
+DAILY_COLS   = ("pickup_date", "trips", "revenue_total", "fare_sum", "tip_sum",
+                "distance_sum", "avg_fare", "avg_tip_pct", "avg_trip_miles")
+PAY_COLS     = ("pickup_date", "payment_type", "trips", "revenue_total", "fare_sum", "tip_sum")
+HOURDOW_COLS   = ("pickup_dow_num", "pickup_hour", "trips")
+ZONE_COLS      = ("borough", "zone", "trips", "revenue_total")
+ZONE_HOUR_COLS = ("borough", "zone", "pickup_hour", "trips", "revenue_total")
+
 try:
-    daily   = read_parquet_dir(f"{S3_PATH}/agg_daily/")
-    hourdow = read_parquet_dir(f"{S3_PATH}/agg_hour_dow/")
-    zonepu  = read_parquet_dir(f"{S3_PATH}/agg_zone_pickup/")
-    pay     = read_parquet_dir(f"{S3_PATH}/agg_payment/")
+    # fetches independentes: dispara os três de uma vez (o leitor S3 do Arrow
+    # solta o GIL), então o bloco custa max(t_i) em vez de sum(t_i)
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_dates = ex.submit(read_parquet_table, f"{S3_PATH}/agg_daily/", ("pickup_date",))
+        f_hd    = ex.submit(read_parquet_table, f"{S3_PATH}/agg_hour_dow/", HOURDOW_COLS)
+        f_zp    = ex.submit(read_parquet_table, f"{S3_PATH}/agg_zone_pickup/", ZONE_COLS)
+        dates_tbl   = f_dates.result()
+        hourdow_tbl = f_hd.result()
+        zonepu_tbl  = f_zp.result()
 except Exception as e:
     st.error(f"Erro ao ler Parquet no S3 ({S3_PATH}). Detalhe: {e}")
     st.stop()
 
-guard_df(daily,   "agg_daily")
-guard_df(hourdow, "agg_hour_dow")
-guard_df(zonepu,  "agg_zone_pickup")
-guard_df(pay,     "agg_payment")
-
-# Tipos
-daily["pickup_date"] = pd.to_datetime(daily["pickup_date"])
-pay["pickup_date"]   = pd.to_datetime(pay["pickup_date"])
+guard_df(dates_tbl,   "agg_daily")
+guard_df(hourdow_tbl, "agg_hour_dow")
+guard_df(zonepu_tbl,  "agg_zone_pickup")
 
 # ========= GEOJSON =========
-taxi_gj = load_taxi_geojson()
+_, zone2fid = load_taxi_geojson()
+slim_gj = simplify_taxi_geojson()
 
 # ========= UI / FILTERS =========
 st.title("🚕 NYC Yellow Taxi — Jun–Jul 2025")
@@ -79,58 +391,65 @@ st.caption(
     "Filtro de HORA aplicado globalmente por ponderação Hora×DOW."
 )
 
-min_d, max_d = daily["pickup_date"].min().date(), daily["pickup_date"].max().date()
+# min/max direto no Arrow: um kernel sobre o buffer, sem materializar DataFrame
+# nem boxear N objetos de data só para achar os limites do widget
+_mm = pc.min_max(dates_tbl["pickup_date"]).as_py()
+min_d, max_d = _mm["min"], _mm["max"]
+if hasattr(min_d, "date"):  # coluna timestamp → o widget quer datetime.date
+    min_d, max_d = min_d.date(), max_d.date()
 c1, c2 = st.columns([2, 1])
 dr = c1.date_input("Período", [min_d, max_d], min_value=min_d, max_value=max_d)
 hr_min, hr_max = c2.select_slider("Hora (pickup)", options=list(range(24)), value=(0, 23))
+d0, d1 = dr[0], dr[1]  # içados uma vez; todo mundo abaixo compara contra os mesmos escalares
 
 # ========= PROPAGAÇÃO DO FILTRO DE HORA =========
-# 1) Fração por DOW dentro do intervalo de horas selecionadas (base: agg_hour_dow)
-assert {"pickup_dow_num", "pickup_hour", "trips"}.issubset(hourdow.columns), "agg_hour_dow com colunas inesperadas."
-dow_tot = hourdow.groupby("pickup_dow_num", as_index=True)["trips"].sum()
-dow_sel = (
-    hourdow[(hourdow["pickup_hour"] >= hr_min) & (hourdow["pickup_hour"] <= hr_max)]
-    .groupby("pickup_dow_num", as_index=True)["trips"].sum()
-)
-ratio_by_dow = (dow_sel / dow_tot).fillna(0).clip(0, 1)  # Series index 1..7
-
-# 2) Série diária/KPIs: aplica a razão conforme o DOW de cada data
-daily_f = daily[(daily.pickup_date >= pd.to_datetime(dr[0])) & (daily.pickup_date <= pd.to_datetime(dr[1]))].copy()
-daily_f["pickup_dow_num"] = daily_f["pickup_date"].dt.dayofweek + 1
-daily_f["__ratio"] = daily_f["pickup_dow_num"].map(ratio_by_dow).fillna(0)
-
-for col in ["trips", "revenue_total", "fare_sum", "tip_sum", "distance_sum"]:
-    if col in daily_f.columns:
-        daily_f[f"{col}__hr"] = daily_f[col] * daily_f["__ratio"]
-
-trips_total   = int(daily_f.get("trips__hr", daily_f.get("trips", pd.Series(dtype=float))).sum())
-revenue_total = float(daily_f.get("revenue_total__hr", daily_f.get("revenue_total", pd.Series(dtype=float))).sum())
-fare_sum      = float(daily_f.get("fare_sum__hr", pd.Series(dtype=float)).sum())
-tip_sum       = float(daily_f.get("tip_sum__hr", pd.Series(dtype=float)).sum())
-dist_sum      = float(daily_f.get("distance_sum__hr", pd.Series(dtype=float)).sum())
+# 1) Fração por DOW dentro do intervalo de horas selecionadas: LUT cacheada
+#    sobre a matriz DOW×hora — os dois groupbys por rerun viram somas de eixo
+ratio_arr = hour_ratio_lut(hr_min, hr_max)
+
+# 2) Série diária/KPIs: o filtro de data desce para o scan (pushdown);
+#    a razão é aplicada conforme o DOW de cada data
+try:
+    scans     = get_scan_cache()
+    daily_tbl = scans.scan(f"{S3_PATH}/agg_daily/", DAILY_COLS, d0, d1)
+    pay_tbl   = scans.scan(f"{S3_PATH}/agg_payment/", PAY_COLS, d0, d1)
+except Exception as e:
+    st.error(f"Erro ao ler Parquet no S3 ({S3_PATH}). Detalhe: {e}")
+    st.stop()
+
+daily_f = table_to_df(daily_tbl)
+pay_f   = table_to_df(pay_tbl)
+
+# KPIs em um passe: soma por DOW no Arrow (viram ≤ 7 linhas) e produto escalar
+# com a razão de cada dia — mesmo total de antes, sem materializar uma coluna
+# *__hr por métrica a cada rerun
+KPI_COLS = ("trips", "revenue_total", "fare_sum", "tip_sum", "distance_sum")
+kpi_g = daily_tbl.group_by("pickup_dow_num").aggregate(
+    [(c, "sum") for c in KPI_COLS if c in daily_tbl.schema.names]
+).to_pandas()
+kpi_w = ratio_arr[kpi_g["pickup_dow_num"].to_numpy()]
+
+def wsum(col: str) -> float:
+    return float((kpi_g[col].to_numpy() * kpi_w).sum()) if col in kpi_g.columns else 0.0
+
+trips_total   = int(wsum("trips_sum"))
+revenue_total = wsum("revenue_total_sum")
+fare_sum      = wsum("fare_sum_sum")
+tip_sum       = wsum("tip_sum_sum")
+dist_sum      = wsum("distance_sum_sum")
 def safe_div(a, b): return (a / b) if (b and b != 0) else 0.0
 avg_fare    = safe_div(fare_sum, trips_total) if fare_sum else (float(daily_f.get("avg_fare", pd.Series([0])).mean()) if trips_total else 0.0)
 avg_tip_pct = safe_div(tip_sum, fare_sum) if fare_sum else (float(daily_f.get("avg_tip_pct", pd.Series([0])).mean()))
 avg_miles   = safe_div(dist_sum, trips_total) if dist_sum else (float(daily_f.get("avg_trip_miles", pd.Series([0])).mean()) if trips_total else 0.0)
 
 # 3) Pagamentos: pondera por DOW da data
-pay_f = pay[(pay.pickup_date >= pd.to_datetime(dr[0])) & (pay.pickup_date <= pd.to_datetime(dr[1]))].copy()
 if not pay_f.empty:
-    pay_f["pickup_dow_num"] = pay_f["pickup_date"].dt.dayofweek + 1
-    pay_f["__ratio"] = pay_f["pickup_dow_num"].map(ratio_by_dow).fillna(0)
-    for col in ["trips", "revenue_total", "fare_sum", "tip_sum"]:
-        if col in pay_f.columns:
-            pay_f[f"{col}__hr"] = pay_f[col] * pay_f["__ratio"]
-
-# 4) Zonas (totalizadas no período): aplica fator global (aproximação)
-sel_all = hourdow[(hourdow["pickup_hour"] >= hr_min) & (hourdow["pickup_hour"] <= hr_max)]["trips"].sum()
-tot_all = hourdow["trips"].sum()
-global_ratio = float(sel_all / tot_all) if tot_all else 0.0
-zonepu_scaled = zonepu.copy()
-if "trips" in zonepu_scaled.columns:
-    zonepu_scaled["trips"] = zonepu_scaled["trips"] * global_ratio
-if "revenue_total" in zonepu_scaled.columns:
-    zonepu_scaled["revenue_total"] = zonepu_scaled["revenue_total"] * global_ratio
+    pay_f["__ratio"] = ratio_arr[pay_f["pickup_dow_num"].to_numpy()]
+    # multiplicação fundida: um walk 2D único em vez de um passe por coluna
+    pay_cols = [c for c in ("trips", "revenue_total", "fare_sum", "tip_sum") if c in pay_f.columns]
+    pay_f[[f"{c}__hr" for c in pay_cols]] = (
+        pay_f[pay_cols].to_numpy(dtype=np.float64) * pay_f["__ratio"].to_numpy()[:, None]
+    )
 
 # ========= KPIs =========
 k1, k2, k3, k4, k5 = st.columns(5)
@@ -141,58 +460,54 @@ k4.metric("Tip % médio", f"{100 * avg_tip_pct:.1f}%")
 k5.metric("Distância média (mi)", f"{avg_miles:.2f}")
 
 # ========= CHARTS =========
-# Série diária (usa trips__hr se existir)
-series_daily = (
-    daily_f
-    .assign(trips_plot=daily_f["trips__hr"] if "trips__hr" in daily_f.columns else daily_f["trips"])
-    .groupby("pickup_date", as_index=False)["trips_plot"].sum()
-    .sort_values("pickup_date")
-)
+# Série diária (trips ponderado pela razão do DOW), cacheada por tupla de filtro;
+# o scan interno bate no ScanCache, então o miss só paga gather + groupby
+series_daily = compute_daily_series(d0, d1, hr_min, hr_max)
 st.plotly_chart(
-    px.line(series_daily, x="pickup_date", y="trips_plot", title="Viagens por dia (filtrado por hora via DOW)"),
+    px.line(series_daily, x="iso_date", y="trips_plot", title="Viagens por dia (filtrado por hora via DOW)"),
     use_container_width=True,
 )
 
-# Heatmap hora × dia-da-semana (exato — vem de agg_hour_dow)
-heat = (
-    hourdow[(hourdow["pickup_hour"] >= hr_min) & (hourdow["pickup_hour"] <= hr_max)]
-    .groupby(["pickup_dow_num", "pickup_hour"], as_index=False)["trips"].sum()
-    .pivot(index="pickup_dow_num", columns="pickup_hour", values="trips")
-    .fillna(0)
-)
-st.plotly_chart(
-    px.imshow(heat, aspect="auto", title="Heatmap (dia da semana × hora)"),
-    use_container_width=True,
-)
+# Heatmap hora × dia-da-semana (exato — vem de agg_hour_dow): a mesma matriz
+# cacheada das razões, fatiada no intervalo de horas
+st.plotly_chart(heatmap_figure(hr_min, hr_max), use_container_width=True)
 
-# Ranking de zonas (escala global — ordem não muda sem base por hora/zone)
-top = (
-    zonepu_scaled.groupby(["borough", "zone"], as_index=False)
-    .agg(trips=("trips", "sum"),
-         revenue=("revenue_total", "sum") if "revenue_total" in zonepu_scaled.columns else ("trips","sum"))
-    .sort_values("trips", ascending=False)
-    .head(15)
-)
+# Ranking de zonas: exato por hora quando o cubo agg_zone_hour está publicado;
+# sem ele, escala global (a ordem não muda sem base por hora/zona). Os dois
+# agregados saem cacheados pela mesma tupla de filtro de hora.
+top, zone_counts, zone_exact = compute_zone_tables(hr_min, hr_max)
 st.dataframe(top, use_container_width=True)
 
-# Mapa por zona (escala global — cor reage ao filtro de hora)
-taxi_gj = load_taxi_geojson()
-zone_counts = zonepu_scaled.groupby("zone", as_index=False)["trips"].sum()
-fig = px.choropleth_mapbox(
-    zone_counts,
-    geojson=taxi_gj,
-    locations="zone",
-    featureidkey="properties.zone",
-    color="trips",
+# Mapa por zona (cor reage ao filtro de hora; exato com o cubo).
+# go.Choroplethmapbox direto: ids e z entram como arrays NumPy (JSON tipado,
+# sem listas Python) e o GeoJSON vai por referência. Sem st.cache_data aqui de
+# propósito — cachear a figura serializaria uma cópia do GeoJSON por entrada.
+fig = go.Figure(go.Choroplethmapbox(
+    geojson=slim_gj,
+    locations=zone_counts["zone"].map(zone2fid).to_numpy(),
+    z=zone_counts["trips"].to_numpy(),
+    # o id inteiro é interno; o hover continua identificando a zona pelo nome
+    text=zone_counts["zone"].astype(str).to_numpy(),
+    hovertemplate="%{text}<br>trips=%{z:.0f}<extra></extra>",
+    colorbar={"title": "trips"},
+    marker_opacity=0.6,
+))
+fig.update_layout(
     mapbox_style="open-street-map",
-    zoom=9,
-    center={"lat": 40.7128, "lon": -74.0060},
-    opacity=0.6,
-    title="Pickups por zona (filtrado por hora — aproximação global)",
+    mapbox_zoom=9,
+    mapbox_center={"lat": 40.7128, "lon": -74.0060},
+    title="Pickups por zona (filtrado por hora — %s)"
+          % ("exato via cubo" if zone_exact else "aproximação global"),
 )
 st.plotly_chart(fig, use_container_width=True)
 
-st.caption(
-    "Filtro de hora aplicado globalmente por ponderação Hora×DOW. "
-    "Para ranking de zonas variar com a hora, é preciso base por hora por zona (ou CTAS 'agg_zone_pickup_hour_v3')."
-)
+if zone_exact:
+    st.caption(
+        "Filtro de hora: série/KPIs por ponderação Hora×DOW; "
+        "ranking e mapa de zonas exatos via cubo 'agg_zone_hour'."
+    )
+else:
+    st.caption(
+        "Filtro de hora aplicado globalmente por ponderação Hora×DOW. "
+        "Para ranking de zonas variar com a hora, publique o CTAS 'agg_zone_hour' (zona×hora)."
+    )